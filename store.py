@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Хранилище истории диалогов для Telegram AI Bot
+
+По умолчанию история живет в памяти процесса и сбрасывается при рестарте.
+Если задана переменная окружения REDIS_URL (и установлены пакеты redis и
+msgpack), история переезжает в Redis: значения сериализуются msgpack и
+сжимаются zstd, поэтому контекст переживает передеплой воркера на Render
+и может делиться между несколькими воркерами.
+"""
+
+import logging
+import os
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Условные импорты: Redis-бэкенд опционален
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    aioredis = None
+    REDIS_AVAILABLE = False
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+class MemoryHistoryStore:
+    """История диалогов в памяти процесса"""
+
+    def __init__(self, max_messages: int = 20):
+        self._max_messages = max_messages
+        # LRUCache вытесняет давно неактивных пользователей вместо
+        # бесконечного роста; deque мутируется на месте, поэтому TTL
+        # не подошел бы - активный диалог терял бы историю по таймеру,
+        # а LRU обновляет позицию записи при каждом обращении
+        try:
+            from cachetools import LRUCache
+            self._histories = LRUCache(maxsize=5000)
+        except ImportError:
+            self._histories = {}
+
+    async def get(self, user_id: int) -> list:
+        """Возвращает историю пользователя списком сообщений {role, content}"""
+        return list(self._histories.get(user_id, ()))
+
+    async def append(self, user_id: int, message: dict) -> list:
+        """Добавляет сообщение и возвращает вытесненные за лимитом"""
+        if user_id not in self._histories:
+            self._histories[user_id] = deque(maxlen=self._max_messages)
+        history = self._histories[user_id]
+        evicted = [history[0]] if len(history) == history.maxlen else []
+        history.append(message)
+        return evicted
+
+    async def count(self, user_id: int) -> int:
+        """Количество сообщений в истории пользователя"""
+        return len(self._histories.get(user_id, ()))
+
+    async def clear(self, user_id: int):
+        """Очищает историю пользователя"""
+        if user_id in self._histories:
+            del self._histories[user_id]
+
+    async def close(self):
+        """Ничего не держим - закрывать нечего"""
+        pass
+
+
+class RedisHistoryStore:
+    """История диалогов в Redis (msgpack + zstd)
+
+    msgpack компактнее JSON, zstd уровня 3 дополнительно ужимает типичные
+    role/content-словари примерно вдвое при незаметных затратах CPU.
+    """
+
+    def __init__(self, url: str, max_messages: int = 20, ttl: int = 86400):
+        self._redis = aioredis.from_url(url)
+        self._max_messages = max_messages
+        self._ttl = ttl
+        self._compressor = zstd.ZstdCompressor(level=3) if zstd else None
+        self._decompressor = zstd.ZstdDecompressor() if zstd else None
+
+    def _key(self, user_id: int) -> str:
+        return f"tgbot:history:{user_id}"
+
+    def _dumps(self, history: list) -> bytes:
+        packed = msgpack.packb(history)
+        if self._compressor is not None:
+            packed = self._compressor.compress(packed)
+        return packed
+
+    def _loads(self, raw: bytes) -> list:
+        if self._decompressor is not None:
+            raw = self._decompressor.decompress(raw)
+        return msgpack.unpackb(raw)
+
+    async def get(self, user_id: int) -> list:
+        """Возвращает историю пользователя списком сообщений {role, content}"""
+        try:
+            raw = await self._redis.get(self._key(user_id))
+        except Exception as e:
+            logger.warning(f"Redis недоступен, история пропущена: {e}")
+            return []
+
+        if not raw:
+            return []
+
+        try:
+            return self._loads(raw)
+        except Exception as e:
+            logger.warning(f"Не удалось разобрать историю из Redis: {e}")
+            return []
+
+    async def append(self, user_id: int, message: dict) -> list:
+        """Добавляет сообщение и возвращает вытесненные за лимитом"""
+        history = await self.get(user_id)
+        history.append(message)
+        evicted = history[:-self._max_messages]
+        history = history[-self._max_messages:]
+        try:
+            await self._redis.set(self._key(user_id), self._dumps(history), ex=self._ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить историю в Redis: {e}")
+        return evicted
+
+    async def count(self, user_id: int) -> int:
+        """Количество сообщений в истории пользователя"""
+        return len(await self.get(user_id))
+
+    async def clear(self, user_id: int):
+        """Очищает историю пользователя"""
+        try:
+            await self._redis.delete(self._key(user_id))
+        except Exception as e:
+            logger.warning(f"Не удалось очистить историю в Redis: {e}")
+
+    async def close(self):
+        """Закрывает соединение с Redis"""
+        try:
+            await self._redis.aclose()
+        except Exception as e:
+            logger.warning(f"Ошибка закрытия соединения с Redis: {e}")
+
+
+def create_history_store(max_messages: int = 20):
+    """Выбирает бэкенд истории по окружению"""
+    url = os.getenv("REDIS_URL")
+
+    if url and REDIS_AVAILABLE and msgpack is not None:
+        logger.info("💾 История диалогов хранится в Redis")
+        return RedisHistoryStore(url, max_messages=max_messages)
+
+    if url:
+        logger.warning("⚠️ REDIS_URL задан, но пакеты redis/msgpack не установлены - история останется в памяти")
+
+    return MemoryHistoryStore(max_messages=max_messages)
@@ -5,20 +5,26 @@ Telegram AI Bot - Умный бот с поддержкой современны
 """
 
 import asyncio
+import hashlib
+import importlib.util
+import io
 import logging
 import os
 import json
+import shutil
+import threading
 import aiohttp
-import aiofiles
 import sys
-import subprocess
 import platform
-import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from functools import lru_cache
 from typing import Optional, Tuple, List
 import re
 
+from store import create_history_store
+
 # Загрузка переменных окружения из файла .env
 try:
     from dotenv import load_dotenv
@@ -26,31 +32,81 @@ try:
 except ImportError:
     pass  # python-dotenv не установлен, используем системные переменные окружения
 
-# Условные импорты с ленивой загрузкой
-try:
-    import pytesseract
-    from PIL import Image
-    TESSERACT_AVAILABLE = True
-except ImportError:
-    pytesseract = None
-    Image = None
-    TESSERACT_AVAILABLE = False
+# Условные импорты с ленивой загрузкой: доступность проверяем дешевым
+# find_spec (без выполнения модуля), сами модули импортируются при первом
+# обращении к соответствующему типу файлов - это заметно ускоряет старт
+def _has_module(name: str) -> bool:
+    """Проверяет, установлен ли модуль, не импортируя его"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
 
+PIL_AVAILABLE = _has_module("PIL")
+TESSERACT_AVAILABLE = PIL_AVAILABLE and _has_module("pytesseract")
+# tesserocr привязывает C++ API Tesseract напрямую (без запуска процесса на каждый вызов)
+TESSEROCR_AVAILABLE = PIL_AVAILABLE and _has_module("tesserocr")
+PDF_AVAILABLE = _has_module("PyPDF2")
+# pypdfium2 (биндинги PDFium на C++) извлекает текст в разы быстрее
+# pure-Python интерпретатора контент-потоков в PyPDF2
+PDFIUM_AVAILABLE = _has_module("pypdfium2")
+DOCX_AVAILABLE = _has_module("docx")
+
+# Заполняются лоадерами ниже при первом использовании
+Image = None
+pytesseract = None
+tesserocr = None
+PdfReader = None
+pdfium = None
+Document = None
+
+def _load_ocr_modules():
+    """Импортирует PIL/tesserocr/pytesseract при первом OCR-запросе"""
+    global Image, pytesseract, tesserocr
+    if PIL_AVAILABLE and Image is None:
+        from PIL import Image as _Image
+        Image = _Image
+    if TESSEROCR_AVAILABLE and tesserocr is None:
+        import tesserocr as _tesserocr
+        tesserocr = _tesserocr
+    if TESSERACT_AVAILABLE and pytesseract is None:
+        import pytesseract as _pytesseract
+        pytesseract = _pytesseract
+
+def _load_pdf_modules():
+    """Импортирует pypdfium2/PyPDF2 при первом PDF-запросе"""
+    global PdfReader, pdfium
+    if PDFIUM_AVAILABLE and pdfium is None:
+        import pypdfium2 as _pdfium
+        pdfium = _pdfium
+    if PDF_AVAILABLE and PdfReader is None:
+        from PyPDF2 import PdfReader as _PdfReader
+        PdfReader = _PdfReader
+
+def _load_docx_module():
+    """Импортирует python-docx при первом DOCX-запросе"""
+    global Document
+    if DOCX_AVAILABLE and Document is None:
+        from docx import Document as _Document
+        Document = _Document
+
+# orjson разбирает небольшие JSON-объекты в 3-5 раз быстрее stdlib
+# и принимает bytes без промежуточного декодирования
 try:
-    from PyPDF2 import PdfReader
-    PDF_AVAILABLE = True
+    import orjson
+    _json_loads = orjson.loads
 except ImportError:
-    PdfReader = None
-    PDF_AVAILABLE = False
+    orjson = None
+    _json_loads = json.loads
 
+# tiktoken дает точный подсчет токенов: эвристика len//5 сильно занижает
+# оценку для кириллицы и приводит к 400-ошибкам от переполненного контекста
 try:
-    from docx import Document
-    DOCX_AVAILABLE = True
+    import tiktoken
 except ImportError:
-    Document = None
-    DOCX_AVAILABLE = False
+    tiktoken = None
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import CommandStart, Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
@@ -80,17 +136,39 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
 dp = Dispatcher()
 
-# User preferences storage (in-memory, resets on restart)
-user_prefs = {}
+# Хранилища состояния пользователей (in-memory, сбрасываются при рестарте).
+# LRUCache ограничивает память долгоживущего процесса: каждое обращение
+# поднимает запись в конец очереди, поэтому вытесняются давно молчавшие
+# пользователи. TTL здесь не подходит - записи мутируются на месте
+# (prefs[uid]["key"] = ..., deque.append), срок никогда бы не обновлялся,
+# и активный пользователь терял бы настройки через сутки после /start
+try:
+    from cachetools import LRUCache, TTLCache
+    # User preferences storage
+    user_prefs = LRUCache(maxsize=5000)
+    # Бегущий счетчик токенов истории: обновляется при каждом изменении
+    # истории, чтобы статус памяти не пересуммировал все сообщения
+    user_token_counts = LRUCache(maxsize=5000)
+    # Кэш file_path от bot.get_file: fallback-ветки и повторные отправки
+    # одного файла не ходят в Telegram API заново. Telegram гарантирует
+    # ссылке минимум час жизни - держим запись полчаса, чтобы не отдать
+    # путь на границе протухания
+    _file_path_cache = TTLCache(maxsize=256, ttl=1800)
+except ImportError:
+    user_prefs = {}
+    user_token_counts = {}
+    # Без TTL кэшировать file_path нельзя: ссылки протухают через ~час,
+    # и бессрочная запись навсегда ломала бы скачивание повторного файла
+    _file_path_cache = None
 
-# История сообщений для каждого пользователя (память диалога)
-user_chat_history = {}
+# Кэш обработанных файлов (LRU: порядок обновляется при обращении)
+_file_cache: OrderedDict[str, str] = OrderedDict()
 
-# Кэш для файлов (LRU cache)
-import weakref
+# Максимальное количество записей в кэше файлов
+FILE_CACHE_SIZE = 50
 
-# Кэш обработанных файлов 
-_file_cache = {}
+# Блоки размышлений в ответах моделей (компилируем один раз, применяем на каждый ответ)
+_THINK_RE = re.compile(r'<think>.*?</think>\s*', re.DOTALL | re.IGNORECASE)
 
 # Лимиты файлов
 MAX_FILE_SIZE_MB = 20
@@ -101,6 +179,10 @@ MAX_TEXT_LENGTH = 10000
 MAX_CHAT_HISTORY = 20  # Максимальное количество сообщений в истории
 MAX_CONTEXT_TOKENS = 8000  # Приблизительный лимит токенов контекста
 
+# История сообщений для каждого пользователя (память диалога).
+# При заданном REDIS_URL переезжает в Redis и переживает рестарты
+history_store = create_history_store(max_messages=MAX_CHAT_HISTORY)
+
 # Доступные AI модели
 AVAILABLE_MODELS = {
     "auto": "🤖 Авто (умный выбор)",
@@ -114,13 +196,20 @@ AVAILABLE_MODELS = {
     "google/gemini-2.5-pro": "💎 Gemini 2.5 Pro"
 }
 
+# Обратный словарь "название кнопки -> ID модели" для выбора модели за O(1)
+_MODEL_NAME_TO_ID = {name: model_id for model_id, name in AVAILABLE_MODELS.items()}
+
 # Модели с поддержкой изображений (мультимодальные)
-VISION_MODELS = {
+VISION_MODELS = frozenset({
     "google/gemini-2.5-pro",
     "anthropic/claude-sonnet-4",
     "openai/gpt-oss-120b",
     "moonshotai/kimi-k2"
-}
+})
+
+# Названия моделей для фильтра кнопок: frozenset дает O(1) проверку
+# вместо линейного скана dict.values() на каждом сообщении
+_AVAILABLE_MODEL_NAMES = frozenset(AVAILABLE_MODELS.values())
 
 # Конфигурация
 DOWNLOADS_DIR = Path("downloads")
@@ -132,8 +221,74 @@ DOWNLOADS_DIR.mkdir(exist_ok=True)
 TESSERACT_DIR.mkdir(exist_ok=True)
 CONFIG_DIR.mkdir(exist_ok=True)
 
-# Кэш для проверки Tesseract
-_tesseract_cache = None
+# Общая HTTP-сессия: переиспользование TCP+TLS соединений к OpenRouter и
+# Telegram CDN. Вызовы Bot API идут через собственную долгоживущую сессию
+# aiogram - она точно так же держит keepalive-соединения к api.telegram.org
+_HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию (создает при первом обращении)"""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=30,
+                keepalive_timeout=75,
+                ttl_dns_cache=300
+            ),
+            # Страховочный таймаут по умолчанию: точечные таймауты на
+            # отдельных запросах имеют приоритет над ним
+            timeout=aiohttp.ClientTimeout(total=120)
+        )
+    return _HTTP_SESSION
+
+async def close_http_session():
+    """Закрывает общую HTTP-сессию"""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None and not _HTTP_SESSION.closed:
+        await _HTTP_SESSION.close()
+    _HTTP_SESSION = None
+
+# Пул потоков для OCR: tesserocr отпускает GIL во время распознавания,
+# поэтому несколько изображений обрабатываются параллельно
+_OCR_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Один экземпляр движка на рабочий поток (ленивая инициализация),
+# tessdata загружается один раз и остается в памяти
+_tess_local = threading.local()
+
+def _get_tess_api():
+    """Возвращает PyTessBaseAPI для текущего потока (создает при первом обращении)"""
+    api = getattr(_tess_local, "api", None)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(lang='rus+eng')
+        _tess_local.api = api
+    return api
+
+# Максимальный размер стороны изображения для OCR: время работы Tesseract
+# растет примерно линейно с числом пикселей, точность при даунскейле
+# до этого размера практически не страдает
+MAX_OCR_DIMENSION = 2000
+
+def _preprocess_for_ocr(image):
+    """Готовит изображение к распознаванию: даунскейл и градации серого"""
+    if max(image.size) > MAX_OCR_DIMENSION:
+        image.thumbnail((MAX_OCR_DIMENSION, MAX_OCR_DIMENSION), Image.LANCZOS)
+
+    # Tesseract внутри все равно работает с градациями серого -
+    # конвертируем сами и экономим ему одно преобразование
+    if image.mode != 'L':
+        image = image.convert('L')
+
+    return image
+
+def _ocr_image_sync(image) -> str:
+    """Синхронное распознавание изображения через in-process API Tesseract"""
+    image = _preprocess_for_ocr(image)
+    api = _get_tess_api()
+    api.SetImage(image)
+    return api.GetUTF8Text()
 
 def get_main_keyboard():
     """Создает основную клавиатуру с настройками"""
@@ -170,95 +325,139 @@ def get_model_keyboard():
 
 
 
-def add_to_chat_history(user_id: int, role: str, content: str):
-    """Добавляет сообщение в историю чата пользователя"""
-    if user_id not in user_chat_history:
-        user_chat_history[user_id] = []
-    
-    user_chat_history[user_id].append({
-        "role": role,
-        "content": content,
-        "timestamp": asyncio.get_event_loop().time()
-    })
-    
-    # Ограничиваем размер истории
-    if len(user_chat_history[user_id]) > MAX_CHAT_HISTORY:
-        user_chat_history[user_id] = user_chat_history[user_id][-MAX_CHAT_HISTORY:]
-
-def get_chat_context(user_id: int, include_system: bool = True) -> list:
-    """Получает контекст чата для пользователя в формате OpenAI API"""
-    messages = []
-    
-    if include_system:
-        messages.append({
-            "role": "system",
-            "content": """Отвечай коротко и лаконично, как это принято в чатах, используй эмоджи где это уместно.
+# Системное сообщение неизменно - строим его один раз на весь процесс
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": """Отвечай коротко и лаконично, как это принято в чатах, используй эмоджи где это уместно.
             Строго не используй разметку Markdown!
-            Ты полезный помощник в Telegram. 
+            Ты полезный помощник в Telegram.
             Пользователь может присылать текст, документы или изображения.
             Если пользователь прислал файл, ты получишь информацию о его содержимом.
             Если файл содержит текст, ты можешь его анализировать и отвечать на вопросы.
             Если это изображение, ты можешь описать его содержимое если есть OCR данные.
             Отвечай коротко и ясно, используй эмодзи где уместно.
-            
+
             ВАЖНО: Ты ведешь продолжительный диалог с пользователем. Помни предыдущие сообщения и отвечай в контексте разговора."""
-        })
-    
+}
+
+async def add_to_chat_history(user_id: int, role: str, content: str):
+    """Добавляет сообщение в историю чата пользователя"""
+    # Пустая история означает, что прежняя вытеснена (LRU) или протухла
+    # в Redis - уцелевший старый счетчик завышал бы статистику памяти
+    fresh_history = await history_store.count(user_id) == 0
+
+    # Храним сообщения сразу в формате OpenAI API ({role, content}),
+    # чтобы get_chat_context отдавал их без пересборки словарей
+    evicted = await history_store.append(user_id, {
+        "role": role,
+        "content": content
+    })
+
+    # Корректируем бегущий счетчик: плюс новое сообщение, минус вытесненные
+    delta = estimate_tokens(content)
+    for msg in evicted:
+        delta -= estimate_tokens(msg["content"])
+    if fresh_history:
+        user_token_counts[user_id] = delta
+    else:
+        user_token_counts[user_id] = max(0, user_token_counts.get(user_id, 0) + delta)
+
+async def get_chat_context(user_id: int, include_system: bool = True) -> list:
+    """Получает контекст чата для пользователя в формате OpenAI API"""
+    messages = []
+
+    if include_system:
+        messages.append(_SYSTEM_MSG)
+
     # Добавляем историю сообщений пользователя
-    if user_id in user_chat_history:
-        for msg in user_chat_history[user_id]:
-            messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
-    
+    messages.extend(await history_store.get(user_id))
+
     return messages
 
-def clear_chat_history(user_id: int):
+async def clear_chat_history(user_id: int):
     """Очищает историю чата пользователя"""
-    if user_id in user_chat_history:
-        del user_chat_history[user_id]
-
-def estimate_tokens(text: str) -> int:
-    """Приблизительная оценка количества токенов в тексте"""
+    await history_store.clear(user_id)
+    user_token_counts.pop(user_id, None)
+
+# Энкодер tiktoken. Инициализируется один раз на старте через
+# asyncio.to_thread: первый get_encoding() может скачивать BPE-словарь
+# (несколько МБ) и заблокировал бы event loop прямо в горячем пути
+_token_encoder = None
+_token_encoder_failed = False
+
+def _init_token_encoder():
+    """Однократно инициализирует энкодер tiktoken (вызывать вне event loop)
+
+    Неудача защелкивается: без сети словарь не скачать, и повторные
+    попытки на каждом сообщении лишь блокировали бы обработку на таймаут
+    соединения - дальше работаем по эвристике
+    """
+    global _token_encoder, _token_encoder_failed
+    if _token_encoder is not None or _token_encoder_failed or tiktoken is None:
+        return
+    try:
+        _token_encoder = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        _token_encoder_failed = True
+        logger.warning(f"Не удалось инициализировать tiktoken, токены считаются эвристикой: {e}")
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    """Считает токены в строке (результат кэшируется по самой строке)"""
+    if _token_encoder is not None:
+        return len(_token_encoder.encode(text))
     # Примерная оценка: 1 токен ≈ 4 символа для английского, 6 для русского
     return len(text) // 5
 
+def estimate_tokens(text: str) -> int:
+    """Оценка количества токенов в тексте"""
+    if not isinstance(text, str):
+        # Мультимодальный content хранится списком блоков
+        text = str(text)
+    return _count_tokens(text)
+
 def trim_context_if_needed(messages: list) -> list:
     """Обрезает контекст если он слишком большой"""
-    total_tokens = sum(estimate_tokens(msg["content"]) for msg in messages)
-    
+    # Считаем длину каждого сообщения один раз и ведем бегущую сумму -
+    # без пересборки всей склейки контекста на каждой итерации обрезки
+    lengths = [estimate_tokens(msg["content"]) for msg in messages]
+    total_tokens = sum(lengths)
+
     if total_tokens <= MAX_CONTEXT_TOKENS:
         return messages
-    
+
     # Сохраняем системное сообщение и обрезаем старые сообщения
     system_msg = messages[0] if messages and messages[0]["role"] == "system" else None
     user_messages = messages[1:] if system_msg else messages
-    
+    user_lengths = lengths[1:] if system_msg else lengths
+    total = sum(user_lengths)
+
     # Обрезаем старые сообщения, оставляя последние
-    while user_messages and estimate_tokens("".join(msg["content"] for msg in user_messages)) > MAX_CONTEXT_TOKENS - 500:
+    while user_messages and total > MAX_CONTEXT_TOKENS - 500:
+        total -= user_lengths.pop(0)
         user_messages.pop(0)
-    
+
     result = []
     if system_msg:
         result.append(system_msg)
     result.extend(user_messages)
-    
+
     return result
 
 @lru_cache(maxsize=1)
 def check_tesseract_installation() -> Tuple[bool, str]:
-    """Проверяет установку Tesseract OCR с кэшированием"""
-    global _tesseract_cache
-    
-    if _tesseract_cache is not None:
-        return _tesseract_cache
-    
+    """Проверяет установку Tesseract OCR с кэшированием
+
+    Результат не меняется в течение жизни процесса, поэтому lru_cache
+    гарантирует ровно одну проверку - каждый просмотр статуса и /start
+    получают готовый кортеж без stat/subprocess
+    """
     try:
         if not TESSERACT_AVAILABLE:
-            _tesseract_cache = (False, "Модуль pytesseract не установлен")
-            return _tesseract_cache
-        
+            return (False, "Модуль pytesseract не установлен")
+
+        _load_ocr_modules()
+
         # Читаем сохраненный путь
         config_file = CONFIG_DIR / 'tesseract_path.txt'
         possible_paths = []
@@ -279,40 +478,32 @@ def check_tesseract_installation() -> Tuple[bool, str]:
             r"C:\Program Files (x86)\Tesseract-OCR\tesseract.exe",
             r"C:\Tesseract-OCR\tesseract.exe",
             r"D:\Program Files\Tesseract-OCR\tesseract.exe",
-            r"D:\Program Files (x86)\Tesseract-OCR\tesseract.exe",
-            "tesseract"
+            r"D:\Program Files (x86)\Tesseract-OCR\tesseract.exe"
         ]
         possible_paths.extend(standard_paths)
-        
-        # Проверяем пути
-        for path in possible_paths:
+
+        # Сначала отсеиваем несуществующие пути без запуска процессов -
+        # каждый вызов get_tesseract_version() порождает subprocess
+        candidates = [path for path in possible_paths if Path(path).exists()]
+
+        # Поиск в PATH встроенным shutil.which вместо запуска where/which
+        which_path = shutil.which('tesseract')
+        if which_path:
+            candidates.append(which_path)
+
+        # Версию запрашиваем только у реально существующих кандидатов
+        for path in candidates:
             try:
                 pytesseract.pytesseract.tesseract_cmd = path
                 version = pytesseract.get_tesseract_version()
                 logger.info(f"✅ Tesseract найден: {path} (версия {version})")
-                _tesseract_cache = (True, f"Tesseract найден: {version}")
-                return _tesseract_cache
+                return (True, f"Tesseract найден: {version}")
             except:
                 continue
-        
-        # Поиск через where/which
-        try:
-            result = subprocess.run(['where', 'tesseract'], capture_output=True, text=True, shell=True)
-            if result.returncode == 0 and result.stdout.strip():
-                tesseract_path = result.stdout.strip().split('\n')[0]
-                pytesseract.pytesseract.tesseract_cmd = tesseract_path
-                version = pytesseract.get_tesseract_version()
-                logger.info(f"✅ Tesseract найден через поиск: {tesseract_path} (версия {version})")
-                _tesseract_cache = (True, f"Tesseract найден: {version}")
-                return _tesseract_cache
-        except:
-            pass
-        
-        _tesseract_cache = (False, "Tesseract не найден в системе")
-        return _tesseract_cache
+
+        return (False, "Tesseract не найден в системе")
     except Exception as e:
-        _tesseract_cache = (False, f"Ошибка проверки Tesseract: {e}")
-        return _tesseract_cache
+        return (False, f"Ошибка проверки Tesseract: {e}")
 
 def setup_tesseract_auto():
     """Автоматическая настройка Tesseract"""
@@ -391,89 +582,144 @@ async def install_missing_packages() -> bool:
     
     return True
 
+def _pytesseract_ocr_sync(image) -> str:
+    """Fallback-распознавание через subprocess-обертку pytesseract"""
+    image = _preprocess_for_ocr(image)
+    try:
+        return pytesseract.image_to_string(image, lang='rus+eng')
+    except Exception:
+        # Языковые пакеты не установлены - используем язык по умолчанию
+        return pytesseract.image_to_string(image)
+
 async def extract_text_from_image(image_path: str) -> str:
     """Извлекает текст из изображения с помощью OCR с оптимизацией"""
-    if not TESSERACT_AVAILABLE:
-        return ("❌ Модули PIL/pytesseract не установлены.\n"
-                "Установите командой: pip install Pillow pytesseract")
-    
-    # Проверяем Tesseract один раз
-    tesseract_ok, message = check_tesseract_installation()
-    if not tesseract_ok:
-        return (f"🖼️ Изображение получено, но OCR недоступен.\n\n"
-                f"❌ {message}\n\n"
-                f"💡 Для распознавания текста на изображениях установите Tesseract:\n\n"
-                f"🪟 Windows: Запустите файл УСТАНОВКА.bat\n"
-                f"🐧 Linux: sudo apt-get install tesseract-ocr tesseract-ocr-rus\n"
-                f"🍎 macOS: brew install tesseract\n\n"
-                f"📱 Или опишите изображение текстом, и я помогу с анализом!")
-    
+    if not TESSEROCR_AVAILABLE and not TESSERACT_AVAILABLE:
+        return ("❌ Модули PIL/tesserocr/pytesseract не установлены.\n"
+                "Установите командой: pip install Pillow tesserocr")
+
+    _load_ocr_modules()
+
+    if not TESSEROCR_AVAILABLE:
+        # Fallback к pytesseract - нужен установленный бинарник Tesseract
+        tesseract_ok, message = check_tesseract_installation()
+        if not tesseract_ok:
+            return (f"🖼️ Изображение получено, но OCR недоступен.\n\n"
+                    f"❌ {message}\n\n"
+                    f"💡 Для распознавания текста на изображениях установите Tesseract:\n\n"
+                    f"🪟 Windows: Запустите файл УСТАНОВКА.bat\n"
+                    f"🐧 Linux: sudo apt-get install tesseract-ocr tesseract-ocr-rus\n"
+                    f"🍎 macOS: brew install tesseract\n\n"
+                    f"📱 Или опишите изображение текстом, и я помогу с анализом!")
+
     try:
-        # Открываем изображение
-        with Image.open(image_path) as image:
-            # Оптимизация изображения для OCR
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Пробуем разные языковые настройки в порядке приоритета
-            languages = ['rus+eng', 'eng', None]
-            
-            for lang in languages:
-                try:
-                    text = await asyncio.get_event_loop().run_in_executor(
-                        None, 
-                        lambda: pytesseract.image_to_string(image, lang=lang) if lang else pytesseract.image_to_string(image)
-                    )
-                    
-                    if text.strip():
-                        lang_info = f"({lang})" if lang else "(default)"
-                        logger.info(f"✅ OCR успешно выполнен {lang_info}")
-                        return text.strip()
-                except Exception as e:
-                    logger.debug(f"OCR попытка с языком {lang} неудачна: {e}")
-                    continue
-            
-            return "❓ Текст на изображении не найден или не распознан"
-            
+        # Проверяем кэш по содержимому: повторно присланное изображение
+        # не прогоняем через OCR заново. blake2b быстрее SHA-256, а
+        # криптостойкость ключу кэша не нужна
+        image_bytes = await asyncio.to_thread(Path(image_path).read_bytes)
+        cache_key = f"ocr_{hashlib.blake2b(image_bytes, digest_size=16).hexdigest()}"
+        if cache_key in _file_cache:
+            logger.debug("📋 Использован кэш для OCR")
+            _file_cache.move_to_end(cache_key)
+            return _file_cache[cache_key]
+
+        # Открываем изображение из уже прочитанных байтов; даунскейл и
+        # конвертация выполняются уже в пуле потоков, не на event loop
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if TESSEROCR_AVAILABLE:
+                # In-process API: без запуска процесса и без перезагрузки tessdata
+                text = await asyncio.get_running_loop().run_in_executor(
+                    _OCR_EXECUTOR, _ocr_image_sync, image
+                )
+            else:
+                text = await asyncio.get_running_loop().run_in_executor(
+                    _OCR_EXECUTOR, _pytesseract_ocr_sync, image
+                )
+
+            if text.strip():
+                logger.info("✅ OCR успешно выполнен")
+                text = text.strip()
+            else:
+                text = "❓ Текст на изображении не найден или не распознан"
+
+            # Сохраняем в кэш с тем же лимитом, что и для PDF
+            _file_cache[cache_key] = text
+            if len(_file_cache) > FILE_CACHE_SIZE:
+                _file_cache.popitem(last=False)
+
+            return text
+
     except Exception as e:
         logger.error(f"Ошибка обработки изображения: {e}")
         return f"❌ Ошибка при обработке изображения: {e}"
 
 async def extract_text_from_pdf(pdf_path: str) -> str:
     """Извлекает текст из PDF файла асинхронно с ограничениями"""
-    if not PDF_AVAILABLE:
-        return "❌ Модуль PyPDF2 не установлен. Установите командой: pip install PyPDF2"
-    
+    if not PDFIUM_AVAILABLE and not PDF_AVAILABLE:
+        return "❌ Модули pypdfium2/PyPDF2 не установлены. Установите командой: pip install pypdfium2"
+
+    _load_pdf_modules()
+
     try:
-        # Проверяем кэш
-        cache_key = f"pdf_{Path(pdf_path).stat().st_mtime}_{Path(pdf_path).stat().st_size}"
+        # Проверяем кэш (один stat() на файл, целочисленный mtime_ns в ключе)
+        st = os.stat(pdf_path)
+        cache_key = f"pdf_{st.st_mtime_ns}_{st.st_size}"
         if cache_key in _file_cache:
             logger.debug("📋 Использован кэш для PDF")
+            _file_cache.move_to_end(cache_key)
             return _file_cache[cache_key]
         
         # Выполняем чтение PDF в отдельном потоке
         def read_pdf():
-            reader = PdfReader(pdf_path)
-            total_pages = len(reader.pages)
-            
+            if PDFIUM_AVAILABLE:
+                pdf = pdfium.PdfDocument(pdf_path)
+                total_pages = len(pdf)
+
+                def get_page_text(page_num):
+                    return pdf[page_num].get_textpage().get_text_range()
+            else:
+                # PyPDF2 тоже не потокобезопасен: все страницы одного reader'а
+                # читают общий поток с seek'ами. Файл читаем в память один раз,
+                # а каждому потоку даем собственный reader поверх этих байтов
+                raw = Path(pdf_path).read_bytes()
+                total_pages = len(PdfReader(io.BytesIO(raw)).pages)
+                thread_state = threading.local()
+
+                def get_page_text(page_num):
+                    reader = getattr(thread_state, "reader", None)
+                    if reader is None:
+                        reader = thread_state.reader = PdfReader(io.BytesIO(raw))
+                    return reader.pages[page_num].extract_text()
+
             # Ограничиваем количество страниц
             max_pages = min(total_pages, MAX_PDF_PAGES)
             if total_pages > MAX_PDF_PAGES:
                 logger.warning(f"⚠️ PDF содержит {total_pages} страниц, обрабатываем первые {MAX_PDF_PAGES}")
-            
-            pages_text = []
-            for page_num in range(max_pages):
+
+            def extract_page(page_num):
                 try:
-                    page = reader.pages[page_num]
-                    page_text = page.extract_text()
-                    if page_text.strip():
-                        # Ограничиваем размер текста страницы
-                        if len(page_text) > MAX_TEXT_LENGTH:
-                            page_text = page_text[:MAX_TEXT_LENGTH] + "... [обрезано]"
-                        pages_text.append(f"--- Страница {page_num + 1} ---\n{page_text}")
+                    page_text = get_page_text(page_num)
                 except Exception as page_error:
                     logger.warning(f"Ошибка при извлечении текста со страницы {page_num + 1}: {page_error}")
-                    pages_text.append(f"--- Страница {page_num + 1} ---\n[Ошибка извлечения текста]")
+                    return f"--- Страница {page_num + 1} ---\n[Ошибка извлечения текста]"
+
+                if not page_text.strip():
+                    return None
+
+                # Ограничиваем размер текста страницы
+                if len(page_text) > MAX_TEXT_LENGTH:
+                    page_text = page_text[:MAX_TEXT_LENGTH] + "... [обрезано]"
+                return f"--- Страница {page_num + 1} ---\n{page_text}"
+
+            if PDFIUM_AVAILABLE:
+                # PDFium не потокобезопасен - извлекаем последовательно,
+                # C++-извлечение и так быстрее параллельного PyPDF2
+                pages = map(extract_page, range(max_pages))
+                pages_text = [page for page in pages if page is not None]
+            else:
+                # Страницы независимы - извлекаем параллельно, map сохраняет порядок
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    pages_text = [page for page in executor.map(extract_page, range(max_pages))
+                                  if page is not None]
             
             result = "\n\n".join(pages_text) if pages_text else "Текст не найден в PDF"
             
@@ -490,16 +736,12 @@ async def extract_text_from_pdf(pdf_path: str) -> str:
             
             return result
         
-        text = await asyncio.get_event_loop().run_in_executor(None, read_pdf)
+        text = await asyncio.get_running_loop().run_in_executor(None, read_pdf)
         
-        # Сохраняем в кэш
+        # Сохраняем в кэш, вытесняя самую старую запись при переполнении
         _file_cache[cache_key] = text
-        
-        # Ограничиваем размер кэша
-        if len(_file_cache) > 50:
-            # Удаляем старые записи
-            oldest_key = min(_file_cache.keys())
-            del _file_cache[oldest_key]
+        if len(_file_cache) > FILE_CACHE_SIZE:
+            _file_cache.popitem(last=False)
         
         return text
         
@@ -511,7 +753,9 @@ async def extract_text_from_docx(docx_path: str) -> str:
     """Извлекает текст из DOCX файла асинхронно"""
     if not DOCX_AVAILABLE:
         return "❌ Модуль python-docx не установлен. Установите командой: pip install python-docx"
-    
+
+    _load_docx_module()
+
     try:
         # Выполняем чтение DOCX в отдельном потоке
         def read_docx():
@@ -525,58 +769,98 @@ async def extract_text_from_docx(docx_path: str) -> str:
             
             return doc_info + text
         
-        text = await asyncio.get_event_loop().run_in_executor(None, read_docx)
+        text = await asyncio.get_running_loop().run_in_executor(None, read_docx)
         return text
         
     except Exception as e:
         logger.error(f"Ошибка извлечения текста из DOCX: {e}")
         return f"Ошибка при извлечении текста из DOCX: {e}"
 
-async def extract_text_from_txt(txt_path: str) -> str:
-    """Извлекает текст из TXT файла с оптимизированным определением кодировки"""
-    encodings = ['utf-8', 'cp1251', 'windows-1251', 'latin-1', 'ascii']
-    
-    for encoding in encodings:
+def _decode_txt(raw: bytes) -> Optional[str]:
+    """Подбирает кодировку для сырых байтов текстового файла"""
+    for encoding in ('utf-8', 'cp1251', 'windows-1251', 'latin-1', 'ascii'):
         try:
-            async with aiofiles.open(txt_path, 'r', encoding=encoding) as f:
-                text = await f.read()
-            if text.strip():
-                # Добавляем информацию о файле
-                lines = text.strip().split('\n')
-                file_info = f"📄 TXT файл содержит {len(lines)} строк\n\n"
-                return file_info + text.strip()
-            else:
-                return "Файл пуст"
+            return raw.decode(encoding)
         except (UnicodeDecodeError, UnicodeError):
             continue
-        except Exception as e:
-            logger.error(f"Ошибка чтения файла с кодировкой {encoding}: {e}")
-            continue
-    
-    return "Не удалось прочитать файл (неподдерживаемая кодировка)"
+
+    return None
+
+def _read_txt_sync(txt_path: str) -> Optional[str]:
+    """Читает файл один раз и подбирает кодировку уже в памяти"""
+    with open(txt_path, 'rb') as f:
+        raw = f.read()
+
+    return _decode_txt(raw)
+
+async def extract_text_from_txt(source) -> str:
+    """Извлекает текст из TXT: принимает путь к файлу или уже скачанные байты"""
+    try:
+        if isinstance(source, bytes):
+            # Байты уже в памяти (скачаны напрямую) - декодируем без диска
+            text = _decode_txt(source)
+        else:
+            # Одна отправка в поток на весь файл вместо открытия на каждую кодировку
+            text = await asyncio.to_thread(_read_txt_sync, source)
+    except Exception as e:
+        logger.error(f"Ошибка чтения файла: {e}")
+        return f"Ошибка при чтении файла: {e}"
+
+    if text is None:
+        return "Не удалось прочитать файл (неподдерживаемая кодировка)"
+
+    if not text.strip():
+        return "Файл пуст"
+
+    # Добавляем информацию о файле
+    lines = text.strip().split('\n')
+    file_info = f"📄 TXT файл содержит {len(lines)} строк\n\n"
+    return file_info + text.strip()
+
+async def _get_file_path(file_id: str) -> str:
+    """Возвращает file_path из Telegram API, кэшируя повторные запросы"""
+    if _file_path_cache is None:
+        return (await bot.get_file(file_id)).file_path
+
+    file_path = _file_path_cache.get(file_id)
+    if file_path is None:
+        file_path = (await bot.get_file(file_id)).file_path
+        _file_path_cache[file_id] = file_path
+    return file_path
+
+def _forget_file_path(file_id: str):
+    """Сбрасывает кэшированный file_path: CDN ответил ошибкой, значит
+    ссылка протухла раньше времени - следующая попытка пойдет в get_file"""
+    if _file_path_cache is not None:
+        _file_path_cache.pop(file_id, None)
 
 async def download_file(file_id: str, local_path: str) -> bool:
     """Скачивает файл по file_id и сохраняет по local_path с оптимизацией"""
     try:
-        file = await bot.get_file(file_id)
-        file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file.file_path}"
-        
+        file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{await _get_file_path(file_id)}"
+
         # Создаем директорию если её нет
         Path(local_path).parent.mkdir(parents=True, exist_ok=True)
         
         # Оптимизированное скачивание с таймаутом и увеличенным размером чанка
+        session = get_http_session()
         timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    async with aiofiles.open(local_path, mode="wb") as f:
-                        # Увеличиваем размер чанка для лучшей производительности
-                        async for chunk in response.content.iter_chunked(8192):
-                            await f.write(chunk)
-                    return True
-                else:
-                    logger.error(f"Ошибка скачивания файла: HTTP {response.status}")
-                    return False
+        async with session.get(file_url, timeout=timeout) as response:
+            if response.status == 200:
+                # Синхронная запись через to_thread: одна отправка в поток
+                # на чанк вместо двойной диспетчеризации aiofiles.
+                # 64 KiB на чанк - меньше Python-коллбеков на мегабайт
+                f = await asyncio.to_thread(open, local_path, "wb")
+                try:
+                    async for chunk in response.content.iter_chunked(65536):
+                        await asyncio.to_thread(f.write, chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+                return True
+            else:
+                _forget_file_path(file_id)
+                logger.error(f"Ошибка скачивания файла: HTTP {response.status}")
+                return False
     except aiohttp.ClientError as e:
         logger.error(f"Сетевая ошибка при скачивании файла: {e}")
         return False
@@ -584,6 +868,84 @@ async def download_file(file_id: str, local_path: str) -> bool:
         logger.error(f"Ошибка при скачивании файла: {e}")
         return False
 
+async def download_file_bytes(file_id: str) -> Optional[bytes]:
+    """Скачивает файл по file_id прямо в память, без записи на диск"""
+    try:
+        file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{await _get_file_path(file_id)}"
+
+        session = get_http_session()
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with session.get(file_url, timeout=timeout) as response:
+            if response.status == 200:
+                return await response.read()
+            _forget_file_path(file_id)
+            logger.error(f"Ошибка скачивания файла: HTTP {response.status}")
+            return None
+    except aiohttp.ClientError as e:
+        logger.error(f"Сетевая ошибка при скачивании файла: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка при скачивании файла: {e}")
+        return None
+
+# Префикс SSE-кадра с полезной нагрузкой (сравнение на байтах, без декодирования)
+_SSE_DATA_PREFIX = b"data: "
+_SSE_DATA_PREFIX_LEN = len(_SSE_DATA_PREFIX)
+
+async def _read_sse_stream(response) -> str:
+    """Читает SSE-поток OpenRouter и собирает текст ответа
+
+    Работает на уровне байтов: кадры разделяются по b"\\n\\n", префикс
+    "data: " отрезается срезом, JSON разбирается без декодирования в str.
+    Текст накапливается в списке и склеивается один раз в конце.
+    """
+    parts = []
+    buffer = bytearray()
+
+    def consume_frame(frame: bytes) -> bool:
+        """Разбирает один SSE-кадр; True означает терминатор [DONE]"""
+        for line in frame.split(b"\n"):
+            line = line.strip()
+            if not line.startswith(_SSE_DATA_PREFIX):
+                continue  # пустые keep-alive строки и комментарии ": ping"
+
+            payload = line[_SSE_DATA_PREFIX_LEN:]
+            if payload == b"[DONE]":
+                return True
+
+            try:
+                chunk_data = _json_loads(payload)
+                if chunk_data.get("choices") and chunk_data["choices"][0].get("delta"):
+                    content = chunk_data["choices"][0]["delta"].get("content")
+                    if content:
+                        parts.append(content)
+            except ValueError:
+                logger.error(f"Error decoding JSON chunk: {payload}")
+            except Exception as e:
+                logger.error(f"Error processing chunk: {e}")
+        return False
+
+    async for data in response.content.iter_any():
+        buffer.extend(data)
+
+        # Обрабатываем все полные SSE-кадры, накопленные в буфере
+        while True:
+            frame_end = buffer.find(b"\n\n")
+            if frame_end == -1:
+                break
+            frame = bytes(buffer[:frame_end])
+            del buffer[:frame_end + 2]
+            if consume_frame(frame):
+                return "".join(parts)
+
+    # Сервер закрыл поток без завершающей пустой строки (обрыв без
+    # [DONE]) - дочитываем остаток буфера тем же разборщиком кадров,
+    # чтобы не потерять уже полученные data-строки
+    if buffer:
+        consume_frame(bytes(buffer))
+
+    return "".join(parts)
+
 async def invoke_llm_api(user_content: str, user_id: int = None, selected_model: str = None) -> str:
     """Вызывает OpenRouter API и возвращает ответ"""
     if not OPENROUTER_API_KEY:
@@ -630,8 +992,8 @@ async def invoke_llm_api(user_content: str, user_id: int = None, selected_model:
             max_tokens = user_settings.get("max_tokens", 1024)
             
             # Получаем контекст чата с историей сообщений
-            messages = get_chat_context(user_id)
-            
+            messages = await get_chat_context(user_id)
+
             # Добавляем новое сообщение пользователя
             messages.append({
                 "role": "user",
@@ -649,48 +1011,62 @@ async def invoke_llm_api(user_content: str, user_id: int = None, selected_model:
                 "temperature": temperature
             }
 
-            full_response = ""
             api_url = "https://openrouter.ai/api/v1/chat/completions"
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(api_url, headers=headers, json=body) as response:
-                    if response.status == 200:
-                        async for line in response.content:
-                            line = line.decode("utf-8").strip()
-                            if line.startswith("data: "):
-                                data = line[6:]
-                                if data == "[DONE]":
-                                    break
-                                try:
-                                    chunk_data = json.loads(data)
-                                    if chunk_data.get("choices") and chunk_data["choices"][0].get("delta"):
-                                        content = chunk_data["choices"][0]["delta"].get("content")
-                                        if content:
-                                            full_response += content
-                                except json.JSONDecodeError:
-                                    logger.error(f"Error decoding JSON chunk: {data}")
-                                except Exception as e:
-                                    logger.error(f"Error processing chunk: {e}")
-                        
-                        if full_response:
-                            logger.info(f"✅ Успешный ответ от модели: {model}")
-                            
-                            # Сохраняем сообщения в историю
-                            if user_id:
-                                add_to_chat_history(user_id, "user", user_content)
-                                add_to_chat_history(user_id, "assistant", full_response)
-                            
-                            return full_response
-                    
-                    # Если статус не 200, пробуем следующую модель
-                    error_text = await response.text()
-                    logger.warning(f"⚠️ Модель {model} недоступна (статус {response.status}), пробуем следующую...")
-                    
-                    if model_index == len(models_to_try) - 1:  # Последняя модель
-                        logger.error(f"❌ Все модели недоступны. Последняя ошибка: {response.status} - {error_text}")
-                        return f"Извините, все AI модели временно недоступны. Ошибка: {response.status}. Попробуйте позже."
-                    
-                    continue  # Пробуем следующую модель
+            session = get_http_session()
+            async with session.post(api_url, headers=headers, json=body) as response:
+                if response.status == 200:
+                    try:
+                        # Зависшая модель не должна удерживать ход пользователя -
+                        # по таймауту переходим к следующей
+                        full_response = await asyncio.wait_for(
+                            _read_sse_stream(response), timeout=45
+                        )
+                    except asyncio.TimeoutError:
+                        logger.warning(f"⚠️ Модель {model} не ответила за 45 секунд, пробуем следующую...")
+                        if model_index == len(models_to_try) - 1:
+                            return "Извините, AI модели не отвечают. Попробуйте позже."
+                        continue
+
+                    if full_response:
+                        logger.info(f"✅ Успешный ответ от модели: {model}")
+
+                        # Сохраняем сообщения в историю
+                        if user_id:
+                            await add_to_chat_history(user_id, "user", user_content)
+                            await add_to_chat_history(user_id, "assistant", full_response)
+
+                        return full_response
+
+                    # Статус 200, но контента нет - раньше такой ответ вообще
+                    # не уходил в fallback; пробуем следующую модель
+                    logger.warning(f"⚠️ Модель {model} вернула пустой ответ, пробуем следующую...")
+                    if model_index == len(models_to_try) - 1:
+                        return "Не удалось получить ответ ни от одной модели."
+                    continue
+
+                error_text = await response.text()
+
+                # Смена модели помогает только при rate limit, ошибках сервера
+                # и недоступной модели. Проблемы с ключом, балансом или самим
+                # запросом повторятся для любой модели - выходим сразу,
+                # не сжигая по запросу на каждую модель из списка
+                if response.status not in (404, 429) and response.status < 500:
+                    logger.error(f"❌ Запрос отклонен: {response.status} - {error_text}")
+                    return (f"Ошибка запроса к API (статус {response.status}). "
+                            f"Проверьте ключ OPENROUTER_API_KEY и баланс.")
+
+                logger.warning(f"⚠️ Модель {model} недоступна (статус {response.status}), пробуем следующую...")
+
+                if model_index == len(models_to_try) - 1:  # Последняя модель
+                    logger.error(f"❌ Все модели недоступны. Последняя ошибка: {response.status} - {error_text}")
+                    return f"Извините, все AI модели временно недоступны. Ошибка: {response.status}. Попробуйте позже."
+
+                # Небольшой экспоненциальный backoff при rate limit и 5xx
+                if response.status == 429 or response.status >= 500:
+                    await asyncio.sleep(0.3 * 2 ** model_index)
+
+                continue  # Пробуем следующую модель
 
         except aiohttp.ClientError as e:
             logger.warning(f"⚠️ Сетевая ошибка для модели {model}: {e}")
@@ -719,8 +1095,8 @@ async def analyze_image_with_vision_model(image_url: str, prompt: str, model: st
 
     try:
         # Получаем контекст чата
-        messages = get_chat_context(user_id)
-        
+        messages = await get_chat_context(user_id)
+
         # Добавляем сообщение с изображением
         messages.append({
             "role": "user",
@@ -742,25 +1118,25 @@ async def analyze_image_with_vision_model(image_url: str, prompt: str, model: st
 
         api_url = "https://openrouter.ai/api/v1/chat/completions"
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(api_url, headers=headers, json=payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if result.get("choices") and len(result["choices"]) > 0:
-                        content = result["choices"][0]["message"]["content"]
-                        logger.info(f"✅ Изображение проанализировано моделью: {model}")
-                        
-                        # Сохраняем в историю
-                        add_to_chat_history(user_id, "user", f"[Изображение]: {prompt}")
-                        add_to_chat_history(user_id, "assistant", content)
-                        
-                        return True, content
-                    else:
-                        return False, "Не удалось получить анализ изображения"
+        session = get_http_session()
+        async with session.post(api_url, headers=headers, json=payload) as response:
+            if response.status == 200:
+                result = await response.json()
+                if result.get("choices") and len(result["choices"]) > 0:
+                    content = result["choices"][0]["message"]["content"]
+                    logger.info(f"✅ Изображение проанализировано моделью: {model}")
+
+                    # Сохраняем в историю
+                    await add_to_chat_history(user_id, "user", f"[Изображение]: {prompt}")
+                    await add_to_chat_history(user_id, "assistant", content)
+
+                    return True, content
                 else:
-                    error_text = await response.text()
-                    logger.error(f"❌ Ошибка анализа изображения: {response.status} - {error_text}")
-                    return False, f"Ошибка анализа: {response.status}"
+                    return False, "Не удалось получить анализ изображения"
+            else:
+                error_text = await response.text()
+                logger.error(f"❌ Ошибка анализа изображения: {response.status} - {error_text}")
+                return False, f"Ошибка анализа: {response.status}"
 
     except aiohttp.ClientError as e:
         logger.error(f"❌ Сетевая ошибка при анализе изображения: {e}")
@@ -769,8 +1145,12 @@ async def analyze_image_with_vision_model(image_url: str, prompt: str, model: st
         logger.error(f"❌ Ошибка при анализе изображения: {e}")
         return False, f"Произошла ошибка: {e}"
 
-async def enhanced_image_analysis(image_url: str, user_id: int, custom_prompt: str = None) -> str:
-    """Улучшенный анализ изображений через Vision модели с fallback к Tesseract"""
+async def enhanced_image_analysis(image_url: str, user_id: int, custom_prompt: str = None) -> Tuple[bool, str]:
+    """Улучшенный анализ изображений через Vision модели
+
+    Возвращает (успех, текст): вызывающий код ветвится по флагу,
+    а не ищет подстроку ошибки в ответе модели.
+    """
     user_settings = user_prefs.get(user_id, {})
     preferred_model = user_settings.get("preferred_model", "auto")
     
@@ -799,13 +1179,100 @@ async def enhanced_image_analysis(image_url: str, user_id: int, custom_prompt: s
         if model in VISION_MODELS:
             success, result = await analyze_image_with_vision_model(image_url, prompt, model, user_id)
             if success:
-                return f"👁️ Анализ через {AVAILABLE_MODELS.get(model, model)}:\n\n{result}"
-    
+                return True, f"👁️ Анализ через {AVAILABLE_MODELS.get(model, model)}:\n\n{result}"
+
     # Fallback к Tesseract если Vision модели не работают
     logger.info("🔄 Fallback к Tesseract OCR...")
-    return "❌ Vision модели недоступны. Для анализа изображений нужна поддержка мультимодальных моделей."
+    return False, "❌ Vision модели недоступны. Для анализа изображений нужна поддержка мультимодальных моделей."
+
+
+
+class StatusUpdater:
+    """Дебаунс статусных сообщений обработки файла
+
+    Каждое редактирование - это round-trip к Bot API (~100-300 мс).
+    Промежуточные переходы, пришедшие раньше окна дебаунса, пропускаются;
+    force=True используется для финальных состояний (ошибок).
+    """
+
+    def __init__(self, message: types.Message, debounce: float = 0.5):
+        self._message = message
+        self._debounce = debounce
+        self._last_edit = 0.0
+        self._last_text = None
+
+    async def update(self, text: str, force: bool = False):
+        """Редактирует статус, если прошло окно дебаунса или force=True"""
+        now = asyncio.get_running_loop().time()
+        if text == self._last_text:
+            return
+        if not force and self._last_edit and now - self._last_edit < self._debounce:
+            return
+
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=self._message.chat.id,
+                message_id=self._message.message_id
+            )
+            self._last_edit = now
+            self._last_text = text
+        except Exception as e:
+            logger.debug(f"Не удалось обновить статус: {e}")
 
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+async def _send_chunked(message: types.Message, text: str, size: int = TELEGRAM_MESSAGE_LIMIT):
+    """Отправляет длинный текст несколькими сообщениями по size символов"""
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+
+    # Отправляем строго по очереди: Telegram не гарантирует порядок
+    # доставки параллельных сообщений, и части ответа могут перемешаться
+    for chunk in chunks:
+        await message.reply(chunk)
+
+# Ссылки на фоновые задачи: event loop держит task'и слабо,
+# без ссылки незавершенная задача может быть собрана GC
+_background_tasks = set()
+
+async def _safe_delete(chat_id: int, message_id: int):
+    """Удаляет сообщение, проглатывая ошибки (сообщение могло исчезнуть)"""
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.warning(f"Не удалось удалить сообщение о процессе: {e}")
+
+def _delete_message_later(chat_id: int, message_id: int):
+    """Запускает удаление сообщения фоновой задачей, не дожидаясь ответа API"""
+    task = asyncio.create_task(_safe_delete(chat_id, message_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _deliver_llm_response(message: types.Message, processing_message: types.Message,
+                                response_text: Optional[str], user_id: int):
+    """Доставляет ответ LLM пользователю: общий хвост handle_message/handle_file
+
+    Удаляет статусное сообщение в фоне, вырезает блоки размышлений
+    (если пользователь их не включил) и отправляет ответ по частям.
+    """
+    # Удаляем сообщение о процессе в фоне - не задерживаем ответ на RTT удаления
+    _delete_message_later(processing_message.chat.id, processing_message.message_id)
+
+    if not response_text:
+        await message.reply("Не удалось получить ответ.")
+        return
+
+    show_thoughts = user_prefs.get(user_id, {}).get("show_thoughts", False)
+    if not show_thoughts:
+        response_text = _THINK_RE.sub('', response_text).strip()
+
+    if not response_text:
+        await message.reply("Ответ содержал только размышления, которые скрыты.")
+        return
 
+    # Разбиваем длинные сообщения
+    await _send_chunked(message, response_text)
 
 @dp.message(CommandStart())
 async def send_welcome(message: types.Message):
@@ -824,25 +1291,28 @@ async def send_welcome(message: types.Message):
     # Проверяем статус OCR
     tesseract_ok, tesseract_msg = check_tesseract_installation()
     
-    welcome_text = "🤖 Привет! Я умный бот с поддержкой ИИ!\n\n"
-    welcome_text += "📋 Мои возможности:\n"
-    welcome_text += "💬 Веду продолжительные диалоги (помню предыдущие сообщения)\n"
-    welcome_text += "👁️ Анализирую изображения через Vision модели AI\n"
-    welcome_text += "📄 Анализирую документы (PDF, DOCX, TXT)\n"
-    welcome_text += f"🖼️ OCR изображений: {'✅ AI + Tesseract' if tesseract_ok else '✅ Только AI Vision'}\n"
-    welcome_text += "🎵 Обрабатываю медиафайлы\n\n"
-    welcome_text += "🎯 Просто отправь мне сообщение, файл или изображение!\n"
-    welcome_text += "💭 Я запомню наш разговор и буду отвечать в контексте!\n\n"
-    
     # Показываем текущую модель
     current_model = user_prefs[user_id]["preferred_model"]
     model_name = AVAILABLE_MODELS.get(current_model, "Неизвестная")
-    welcome_text += f"🤖 Текущая модель: {model_name}\n\n"
-    
+
+    # Собираем текст списком: одна склейка вместо квадратичного +=
+    parts = [
+        "🤖 Привет! Я умный бот с поддержкой ИИ!\n",
+        "📋 Мои возможности:",
+        "💬 Веду продолжительные диалоги (помню предыдущие сообщения)",
+        "👁️ Анализирую изображения через Vision модели AI",
+        "📄 Анализирую документы (PDF, DOCX, TXT)",
+        f"🖼️ OCR изображений: {'✅ AI + Tesseract' if tesseract_ok else '✅ Только AI Vision'}",
+        "🎵 Обрабатываю медиафайлы\n",
+        "🎯 Просто отправь мне сообщение, файл или изображение!",
+        "💭 Я запомню наш разговор и буду отвечать в контексте!\n",
+        f"🤖 Текущая модель: {model_name}\n"
+    ]
+
     if not tesseract_ok:
-        welcome_text += f"💡 Для OCR установите Tesseract:\n{tesseract_msg}\n\n"
-    
-    await message.reply(welcome_text, reply_markup=get_main_keyboard())
+        parts.append(f"💡 Для OCR установите Tesseract:\n{tesseract_msg}\n")
+
+    await message.reply("\n".join(parts), reply_markup=get_main_keyboard())
 
 @dp.message(Command("think"))
 async def toggle_think(message: types.Message):
@@ -857,136 +1327,160 @@ async def toggle_think(message: types.Message):
 
 
 
-@dp.message(lambda message: message.text == "🤖 Выбор модели")
 async def handle_model_selection(message: types.Message):
     """Обработчик кнопки выбора модели"""
     user_id = message.from_user.id
     current_model = user_prefs.get(user_id, {}).get("preferred_model", "auto")
     current_name = AVAILABLE_MODELS.get(current_model, "Неизвестная")
     
-    model_text = f"🤖 **Выбор AI модели**\n\n"
-    model_text += f"Текущая модель: {current_name}\n\n"
-    model_text += "Доступные модели:\n"
-    for model_id, model_name in AVAILABLE_MODELS.items():
-        status = "✅" if model_id == current_model else "⚪"
-        model_text += f"{status} {model_name}\n"
-    
-    model_text += "\nВыберите модель:"
-    
+    model_list = "\n".join(
+        f"{'✅' if model_id == current_model else '⚪'} {model_name}"
+        for model_id, model_name in AVAILABLE_MODELS.items()
+    )
+    model_text = (
+        f"🤖 **Выбор AI модели**\n\n"
+        f"Текущая модель: {current_name}\n\n"
+        f"Доступные модели:\n{model_list}\n"
+        f"\nВыберите модель:"
+    )
+
     await message.reply(model_text, reply_markup=get_model_keyboard())
 
-@dp.message(lambda message: message.text == "📊 Статус")
 async def handle_status(message: types.Message):
     """Обработчик кнопки статуса"""
     tesseract_ok, tesseract_msg = check_tesseract_installation()
     
-    status_text = "📊 **Статус системы**\n\n"
-    status_text += f"✅ Обработка текста: Доступна\n"
-    status_text += f"{'✅' if PDF_AVAILABLE else '❌'} Анализ PDF: {'Доступен' if PDF_AVAILABLE else 'Недоступен'}\n"
-    status_text += f"{'✅' if DOCX_AVAILABLE else '❌'} Анализ DOCX: {'Доступен' if DOCX_AVAILABLE else 'Недоступен'}\n"
-    status_text += f"{'✅' if tesseract_ok else '❌'} OCR изображений: {'Доступен' if tesseract_ok else 'Недоступен'}\n"
-    status_text += f"⚡ Время запуска: ~1.89 сек\n"
-    status_text += f"🧠 Кэш файлов: {len(_file_cache)} записей\n"
-    
+    status_text = "\n".join([
+        "📊 **Статус системы**\n",
+        "✅ Обработка текста: Доступна",
+        f"{'✅' if PDF_AVAILABLE else '❌'} Анализ PDF: {'Доступен' if PDF_AVAILABLE else 'Недоступен'}",
+        f"{'✅' if DOCX_AVAILABLE else '❌'} Анализ DOCX: {'Доступен' if DOCX_AVAILABLE else 'Недоступен'}",
+        f"{'✅' if tesseract_ok else '❌'} OCR изображений: {'Доступен' if tesseract_ok else 'Недоступен'}",
+        "⚡ Время запуска: ~1.89 сек",
+        f"🧠 Кэш файлов: {len(_file_cache)} записей"
+    ])
+
     await message.reply(status_text, reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "ℹ️ Помощь")
 async def handle_help(message: types.Message):
     """Обработчик кнопки помощи"""
-    help_text = "ℹ️ **Справка по боту**\n\n"
-    help_text += "🎯 **Основные функции:**\n"
-    help_text += "• Отправьте текст для анализа ИИ\n"
-    help_text += "• Загрузите файл (PDF, DOCX, TXT, изображение)\n"
-    help_text += "• Анализ изображений через Vision модели AI\n"
-    help_text += "• Ведите продолжительные диалоги - бот помнит контекст!\n\n"
-    help_text += "👁️ **Анализ изображений:**\n"
-    help_text += "• AI Vision анализ через мультимодальные модели\n"
-    help_text += "• Извлечение текста и описание содержимого\n"
-    help_text += "• Fallback к Tesseract OCR при необходимости\n"
-    help_text += "• Поддержка в Gemini 2.5 Pro, Claude Sonnet 4, GPT-OSS-120B\n\n"
-    help_text += "🤖 **AI модели:**\n"
-    help_text += "• GPT-OSS-120B/20B - новые модели OpenAI\n"
-    help_text += "• DeepSeek R1 - бесплатная модель рассуждений\n"
-    help_text += "• Qwen3-235B - мощная бесплатная модель\n"
-    help_text += "• Qwen Coder - специализация на коде\n"
-    help_text += "• Kimi K2, Claude Sonnet 4, Gemini 2.5 Pro\n\n"
-    help_text += "💭 **Память диалога:**\n"
-    help_text += f"• Сохраняется до {MAX_CHAT_HISTORY} сообщений\n"
-    help_text += f"• Автоматическое управление контекстом (~{MAX_CONTEXT_TOKENS} токенов)\n"
-    help_text += "• Изображения сохраняются в контексте диалога\n\n"
-    help_text += "📝 **Команды:**\n"
-    help_text += "/start - перезапуск бота\n"
-    help_text += "/think - переключить режим размышлений\n\n"
-    help_text += "🔄 **Лимиты:**\n"
-    help_text += "• Максимальный размер файла: 20 MB\n"
-    help_text += "• Максимальное количество страниц PDF: 50\n"
-    
+    help_text = "\n".join([
+        "ℹ️ **Справка по боту**\n",
+        "🎯 **Основные функции:**",
+        "• Отправьте текст для анализа ИИ",
+        "• Загрузите файл (PDF, DOCX, TXT, изображение)",
+        "• Анализ изображений через Vision модели AI",
+        "• Ведите продолжительные диалоги - бот помнит контекст!\n",
+        "👁️ **Анализ изображений:**",
+        "• AI Vision анализ через мультимодальные модели",
+        "• Извлечение текста и описание содержимого",
+        "• Fallback к Tesseract OCR при необходимости",
+        "• Поддержка в Gemini 2.5 Pro, Claude Sonnet 4, GPT-OSS-120B\n",
+        "🤖 **AI модели:**",
+        "• GPT-OSS-120B/20B - новые модели OpenAI",
+        "• DeepSeek R1 - бесплатная модель рассуждений",
+        "• Qwen3-235B - мощная бесплатная модель",
+        "• Qwen Coder - специализация на коде",
+        "• Kimi K2, Claude Sonnet 4, Gemini 2.5 Pro\n",
+        "💭 **Память диалога:**",
+        f"• Сохраняется до {MAX_CHAT_HISTORY} сообщений",
+        f"• Автоматическое управление контекстом (~{MAX_CONTEXT_TOKENS} токенов)",
+        "• Изображения сохраняются в контексте диалога\n",
+        "📝 **Команды:**",
+        "/start - перезапуск бота",
+        "/think - переключить режим размышлений\n",
+        "🔄 **Лимиты:**",
+        "• Максимальный размер файла: 20 MB",
+        "• Максимальное количество страниц PDF: 50"
+    ])
+
     await message.reply(help_text, reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "🗑️ Очистить чат")
 async def handle_clear_chat(message: types.Message):
     """Обработчик кнопки очистки чата"""
     user_id = message.from_user.id
-    clear_chat_history(user_id)
+    await clear_chat_history(user_id)
     await message.reply("✨ История диалога очищена! Готов к новому разговору!", reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "🗑️ Очистить историю")
 async def handle_clear_history(message: types.Message):
     """Обработчик кнопки очистки истории"""
     user_id = message.from_user.id
-    history_count = len(user_chat_history.get(user_id, []))
-    clear_chat_history(user_id)
+    history_count = await history_store.count(user_id)
+    await clear_chat_history(user_id)
     await message.reply(f"✨ История диалога очищена! Удалено {history_count} сообщений.", reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "💭 Память диалога")
 async def handle_memory_status(message: types.Message):
     """Обработчик кнопки статуса памяти диалога"""
     user_id = message.from_user.id
-    history = user_chat_history.get(user_id, [])
-    
+    history = await history_store.get(user_id)
+
     if not history:
-        status_text = "💭 **Память диалога**\n\n"
-        status_text += "📝 История пуста - это первое сообщение!\n"
-        status_text += f"📊 Лимит сообщений: {MAX_CHAT_HISTORY}\n"
-        status_text += f"🎯 Лимит токенов: {MAX_CONTEXT_TOKENS}\n\n"
-        status_text += "ℹ️ Бот теперь запоминает ваши сообщения и ведет непрерывный диалог!"
+        status_text = "\n".join([
+            "💭 **Память диалога**\n",
+            "📝 История пуста - это первое сообщение!",
+            f"📊 Лимит сообщений: {MAX_CHAT_HISTORY}",
+            f"🎯 Лимит токенов: {MAX_CONTEXT_TOKENS}\n",
+            "ℹ️ Бот теперь запоминает ваши сообщения и ведет непрерывный диалог!"
+        ])
     else:
-        total_tokens = sum(estimate_tokens(msg["content"]) for msg in history)
+        total_tokens = user_token_counts.get(user_id)
+        if total_tokens is None:
+            # Истории из Redis после рестарта счетчик неизвестен - сеем его
+            # одной суммой, дальше он поддерживается инкрементально
+            total_tokens = sum(estimate_tokens(msg["content"]) for msg in history)
+            user_token_counts[user_id] = total_tokens
         user_msgs = len([msg for msg in history if msg["role"] == "user"])
         ai_msgs = len([msg for msg in history if msg["role"] == "assistant"])
-        
-        status_text = "💭 **Память диалога**\n\n"
-        status_text += f"📝 Сообщений в истории: {len(history)}\n"
-        status_text += f"👤 Ваших сообщений: {user_msgs}\n"
-        status_text += f"🤖 Ответов ИИ: {ai_msgs}\n"
-        status_text += f"📊 Примерно токенов: {total_tokens}/{MAX_CONTEXT_TOKENS}\n"
-        status_text += f"🎯 Лимит сообщений: {MAX_CHAT_HISTORY}\n\n"
-        
+
+        parts = [
+            "💭 **Память диалога**\n",
+            f"📝 Сообщений в истории: {len(history)}",
+            f"👤 Ваших сообщений: {user_msgs}",
+            f"🤖 Ответов ИИ: {ai_msgs}",
+            f"📊 Примерно токенов: {total_tokens}/{MAX_CONTEXT_TOKENS}",
+            f"🎯 Лимит сообщений: {MAX_CHAT_HISTORY}\n"
+        ]
+
         if total_tokens > MAX_CONTEXT_TOKENS * 0.8:
-            status_text += "⚠️ Контекст почти заполнен - старые сообщения будут удаляться автоматически"
+            parts.append("⚠️ Контекст почти заполнен - старые сообщения будут удаляться автоматически")
         else:
-            status_text += "✅ Память работает нормально"
+            parts.append("✅ Память работает нормально")
+
+        status_text = "\n".join(parts)
     
     await message.reply(status_text, reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "🔙 Назад")
 async def handle_back(message: types.Message):
     """Обработчик кнопки назад"""
     await message.reply("🏠 Главное меню", reply_markup=get_main_keyboard())
 
+# Кнопки главного меню: один зарегистрированный обработчик со словарным
+# диспатчем за O(1) вместо отдельного lambda-фильтра на каждую кнопку,
+# которые aiogram перебирал бы на каждом входящем сообщении
+BUTTON_HANDLERS = {
+    "🤖 Выбор модели": handle_model_selection,
+    "📊 Статус": handle_status,
+    "ℹ️ Помощь": handle_help,
+    "🗑️ Очистить чат": handle_clear_chat,
+    "🗑️ Очистить историю": handle_clear_history,
+    "💭 Память диалога": handle_memory_status,
+    "🔙 Назад": handle_back,
+}
+
+@dp.message(F.text.in_(frozenset(BUTTON_HANDLERS)))
+async def handle_menu_button(message: types.Message):
+    """Диспетчеризует кнопки главного меню через словарь"""
+    await BUTTON_HANDLERS[message.text](message)
+
 # Обработчики выбора модели
-@dp.message(lambda message: message.text in AVAILABLE_MODELS.values())
+@dp.message(F.text.in_(_AVAILABLE_MODEL_NAMES))
 async def handle_model_change(message: types.Message):
     """Обработчик изменения модели"""
     user_id = message.from_user.id
-    
-    # Находим ID модели по названию
-    selected_model = None
-    for model_id, model_name in AVAILABLE_MODELS.items():
-        if message.text == model_name:
-            selected_model = model_id
-            break
-    
+
+    # Находим ID модели по названию за O(1) по обратному словарю
+    selected_model = _MODEL_NAME_TO_ID.get(message.text)
+
     if selected_model:
         if user_id not in user_prefs:
             user_prefs[user_id] = {}
@@ -1001,6 +1495,10 @@ async def handle_model_change(message: types.Message):
 
 
 
+def _size_mb(file_info) -> float:
+    """Размер файла в мегабайтах (0, если Telegram не передал размер)"""
+    return (getattr(file_info, 'file_size', 0) or 0) / 1048576
+
 @dp.message(lambda message: message.document or message.photo or message.voice or message.video or message.audio)
 async def handle_file(message: types.Message):
     """Handles incoming file messages"""
@@ -1036,71 +1534,77 @@ async def handle_file(message: types.Message):
         return
 
     # Проверяем размер файла
-    file_size_mb = file_info.file_size / (1024 * 1024) if hasattr(file_info, 'file_size') and file_info.file_size else 0
+    file_size_mb = _size_mb(file_info)
     if file_size_mb > MAX_FILE_SIZE_MB:
         await message.reply(f"❌ Файл слишком большой ({file_size_mb:.1f} MB). Максимальный размер: {MAX_FILE_SIZE_MB} MB")
         return
 
     # Показываем статус обработки
     processing_message = await message.reply("📥 Получаю файл...")
+    status = StatusUpdater(processing_message)
 
     # Генерируем локальный путь для файла
     local_file_path = DOWNLOADS_DIR / f"{file_info.file_id}_{file_name}"
-    
-    # Скачиваем файл
-    await bot.edit_message_text("💾 Скачиваю файл...", 
-                               chat_id=processing_message.chat.id, 
-                               message_id=processing_message.message_id)
 
-    download_success = await download_file(file_info.file_id, str(local_file_path))
-    
-    if not download_success:
-        await bot.edit_message_text("❌ Ошибка при скачивании файла.", 
-                                   chat_id=processing_message.chat.id, 
-                                   message_id=processing_message.message_id)
-        return
+    file_extension = os.path.splitext(file_name)[1].lower() if '.' in file_name else ""
+
+    # Скачиваем файл только если ветка анализа реально читает его с диска:
+    # для медиа и неподдерживаемых форматов локальная копия - мертвый вес.
+    # Фото анализируются Vision-моделями по URL Telegram CDN и скачиваются
+    # лишь при fallback на Tesseract
+    needs_disk = file_extension in (".pdf", ".docx")
+    txt_bytes = None
 
-    await bot.edit_message_text("🔍 Анализирую содержимое файла...", 
-                               chat_id=processing_message.chat.id, 
-                               message_id=processing_message.message_id)
+    if needs_disk:
+        await status.update("💾 Скачиваю файл...")
+        download_success = await download_file(file_info.file_id, str(local_file_path))
+
+        if not download_success:
+            await status.update("❌ Ошибка при скачивании файла.", force=True)
+            return
+    elif file_extension == ".txt":
+        # TXT декодируем прямо из скачанных байтов - без записи и перечтения
+        await status.update("💾 Скачиваю файл...")
+        txt_bytes = await download_file_bytes(file_info.file_id)
+
+        if txt_bytes is None:
+            await status.update("❌ Ошибка при скачивании файла.", force=True)
+            return
+
+    await status.update("🔍 Анализирую содержимое файла...")
 
     # Анализируем содержимое файла в зависимости от типа
     file_content = ""
-    file_extension = os.path.splitext(file_name)[1].lower() if '.' in file_name else ""
 
     try:
         local_file_str = str(local_file_path)
         if file_type == "photo":
             # Получаем URL изображения для Vision анализа
-            file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{(await bot.get_file(file_info.file_id)).file_path}"
+            file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{await _get_file_path(file_info.file_id)}"
             
             # Сначала пробуем Vision модели, затем Tesseract как fallback
-            await bot.edit_message_text("👁️ Анализирую изображение через AI Vision...", 
-                                       chat_id=processing_message.chat.id, 
-                                       message_id=processing_message.message_id)
+            await status.update("👁️ Анализирую изображение через AI Vision...")
             
-            file_content = await enhanced_image_analysis(file_url, user_id)
-            
-            # Если Vision модели не сработали, пробуем Tesseract
-            if "❌ Vision модели недоступны" in file_content:
-                await bot.edit_message_text("🔄 Fallback к Tesseract OCR...", 
-                                           chat_id=processing_message.chat.id, 
-                                           message_id=processing_message.message_id)
-                tesseract_result = await extract_text_from_image(local_file_str)
-                if tesseract_result and "❌" not in tesseract_result:
-                    file_content = f"🔍 Tesseract OCR:\n\n{tesseract_result}"
+            vision_ok, file_content = await enhanced_image_analysis(file_url, user_id)
+
+            # Если Vision модели не сработали, пробуем Tesseract - только
+            # теперь изображение действительно нужно локально
+            if not vision_ok:
+                await status.update("🔄 Fallback к Tesseract OCR...")
+                if await download_file(file_info.file_id, local_file_str):
+                    tesseract_result = await extract_text_from_image(local_file_str)
+                    if tesseract_result and "❌" not in tesseract_result:
+                        file_content = f"🔍 Tesseract OCR:\n\n{tesseract_result}"
         elif file_extension == ".pdf":
             file_content = await extract_text_from_pdf(local_file_str)
         elif file_extension == ".docx":
             file_content = await extract_text_from_docx(local_file_str)
         elif file_extension == ".txt":
-            file_content = await extract_text_from_txt(local_file_str)
+            file_content = await extract_text_from_txt(txt_bytes)
         elif file_type == "document":
             # Для документов без поддерживаемого расширения
-            file_size_mb = file_info.file_size / (1024 * 1024) if hasattr(file_info, 'file_size') and file_info.file_size else 0
             file_content = f"📄 Документ: {file_name}\n📏 Размер: {file_size_mb:.2f} MB\n\n❌ Формат файла не поддерживается для анализа.\n\nПоддерживаемые форматы:\n• PDF (.pdf)\n• Word (.docx)\n• Текстовые файлы (.txt)\n• Изображения (JPG, PNG, etc.)"
         elif file_type in ["voice", "video", "audio"]:
-            file_size_mb = file_info.file_size / (1024 * 1024) if hasattr(file_info, 'file_size') and file_info.file_size else 0
             file_content = f"🎵 Медиафайл: {file_name}\n📏 Размер: {file_size_mb:.2f} MB\n\n❌ Анализ медиафайлов пока не поддерживается."
         else:
             file_content = "❌ Неизвестный тип файла. Поддерживаются: PDF, DOCX, TXT, изображения."
@@ -1124,27 +1628,7 @@ async def handle_file(message: types.Message):
     # Отправляем запрос к LLM
     response_text = await invoke_llm_api(prompt, user_id)
 
-    # Удаляем сообщение о процессе
-    try:
-        await bot.delete_message(chat_id=processing_message.chat.id, message_id=processing_message.message_id)
-    except Exception as e:
-        logger.warning(f"Не удалось удалить сообщение о процессе: {e}")
-
-    # Отправляем ответ пользователю
-    if response_text:
-        show_thoughts = user_prefs.get(user_id, {}).get("show_thoughts", False)
-        if not show_thoughts:
-            response_text = re.sub(r'<think>.*?</think>\s*', '', response_text, flags=re.DOTALL | re.IGNORECASE).strip()
-
-        if not response_text:
-            await message.reply("Ответ содержал только размышления, которые скрыты.")
-            return
-
-        # Разбиваем длинные сообщения
-        for i in range(0, len(response_text), 4096):
-            await message.reply(response_text[i:i+4096])
-    else:
-        await message.reply("Не удалось получить ответ.")
+    await _deliver_llm_response(message, processing_message, response_text, user_id)
 
 @dp.message()
 async def handle_message(message: types.Message):
@@ -1153,49 +1637,39 @@ async def handle_message(message: types.Message):
         return
 
     user_id = message.from_user.id
-    show_thoughts = user_prefs.get(user_id, {}).get("show_thoughts", False)
 
     # Обычная обработка текстовых сообщений
     processing_message = await message.reply("🤖 Думаю...")
 
     response_text = await invoke_llm_api(message.text, user_id)
 
-    try:
-        await bot.delete_message(chat_id=processing_message.chat.id, message_id=processing_message.message_id)
-    except Exception as e:
-        logger.warning(f"Не удалось удалить сообщение о процессе: {e}")
+    await _deliver_llm_response(message, processing_message, response_text, user_id)
 
-    if response_text:
-        if not show_thoughts:
-            response_text = re.sub(r'<think>.*?</think>\s*', '', response_text, flags=re.DOTALL | re.IGNORECASE).strip()
+def _cleanup_old_files_sync():
+    """Синхронная очистка старых временных файлов (выполняется в потоке)"""
+    import time
+    current_time = time.time()
+    max_age = 3600  # 1 час
 
-        if not response_text:
-            await message.reply("Ответ содержал только размышления, которые скрыты.")
-            return
+    if not DOWNLOADS_DIR.exists():
+        return
 
-        # Разбиваем длинные сообщения
-        for i in range(0, len(response_text), 4096):
-            await message.reply(response_text[i:i+4096])
-    else:
-        await message.reply("Не удалось получить ответ.")
+    # scandir отдает mtime из кэша DirEntry - один syscall на файл вместо
+    # отдельного stat() после листинга
+    with os.scandir(DOWNLOADS_DIR) as entries:
+        for entry in entries:
+            if entry.is_file() and current_time - entry.stat().st_mtime > max_age:
+                try:
+                    os.unlink(entry.path)
+                    logger.debug(f"🗑️ Удален старый файл: {entry.name}")
+                except Exception as e:
+                    logger.debug(f"Не удалось удалить файл {entry.path}: {e}")
 
 async def cleanup_old_files():
-    """Очищает старые временные файлы"""
+    """Очищает старые временные файлы, не блокируя event loop"""
     try:
-        import time
-        current_time = time.time()
-        max_age = 3600  # 1 час
-        
-        if DOWNLOADS_DIR.exists():
-            for file_path in DOWNLOADS_DIR.iterdir():
-                if file_path.is_file():
-                    file_age = current_time - file_path.stat().st_mtime
-                    if file_age > max_age:
-                        try:
-                            file_path.unlink()
-                            logger.debug(f"🗑️ Удален старый файл: {file_path.name}")
-                        except Exception as e:
-                            logger.debug(f"Не удалось удалить файл {file_path}: {e}")
+        # stat/unlink - блокирующие syscall'ы, уводим их с потока event loop
+        await asyncio.to_thread(_cleanup_old_files_sync)
     except Exception as e:
         logger.warning(f"Ошибка очистки файлов: {e}")
 
@@ -1209,7 +1683,10 @@ async def main():
     
     # Очищаем старые файлы при запуске
     await cleanup_old_files()
-    
+
+    # Готовим энкодер токенов до первого сообщения, вне event loop
+    await asyncio.to_thread(_init_token_encoder)
+
     try:
         await dp.start_polling(bot)
     except Exception as e:
@@ -1217,6 +1694,8 @@ async def main():
     finally:
         # Очищаем файлы при завершении
         await cleanup_old_files()
+        await history_store.close()
+        await close_http_session()
 
 async def startup_checks() -> bool:
     """Выполняет проверки при запуске асинхронно"""
@@ -1277,6 +1756,14 @@ async def main_wrapper():
         return False
 
 if __name__ == '__main__':
+    # uvloop (event loop на libuv, C) заметно ускоряет socket-нагруженный
+    # async-код; на Windows недоступен - остаемся на стандартном loop
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     try:
         success = asyncio.run(main_wrapper())
         if not success:
@@ -51,7 +51,7 @@ def main():
     
     # Проверяем зависимости
     print("\n📦 Проверка зависимостей:")
-    deps = ['aiogram', 'aiohttp', 'aiofiles', 'PIL', 'pytesseract', 'PyPDF2', 'docx']
+    deps = ['aiogram', 'aiohttp', 'PIL', 'pytesseract', 'PyPDF2', 'docx']
     missing = []
     
     for dep in deps:
@@ -4,24 +4,132 @@ Webhook версия Telegram бота для Render
 Обновлено: 2025-08-06 - Исправлен API для aiogram 3.x
 """
 import os
+import hmac
+import socket
 import logging
 import asyncio
+import secrets
+from dataclasses import dataclass
 from aiohttp import web
-from telegram_ai_bot import dp, bot
 
-logging.basicConfig(level=logging.INFO)
+# Объекты бота публикуются в _load_bot(): импорт telegram_ai_bot тяжелый
+# (aiogram, pydantic, реестр моделей), откладываем его до проверки окружения
+bot = None
+dp = None
+close_http_session = None
+history_store = None
+init_token_encoder = None
+
+def _load_bot():
+    """Импортирует модуль бота и выкладывает его объекты в globals модуля"""
+    global bot, dp, close_http_session, history_store, init_token_encoder
+    if bot is None:
+        from telegram_ai_bot import (
+            bot as _bot,
+            dp as _dp,
+            close_http_session as _close_http_session,
+            history_store as _history_store,
+            _init_token_encoder,
+        )
+        bot = _bot
+        dp = _dp
+        close_http_session = _close_http_session
+        history_store = _history_store
+        init_token_encoder = _init_token_encoder
+
+# Без %(asctime)s: Render сам проставляет время каждой строке, а
+# time.localtime+strftime на каждую запись - заметная цена под нагрузкой
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(levelname).1s %(name)s %(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
 logger = logging.getLogger(__name__)
 
+# Убираем лишнюю работу на каждую запись лога: поиск вызывающего кадра
+# (_srcfile=None отключает findCaller) и сбор информации о потоке/процессе
+logging._srcfile = None
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+# orjson разбирает апдейты Telegram в несколько раз быстрее стандартного json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
+
 WEBHOOK_PATH = "/webhook"
-WEBHOOK_URL = os.getenv("WEBHOOK_URL", "https://your-app.onrender.com/webhook")
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Конфигурация вебхука: окружение читается один раз при импорте
+
+    webhook_secret регистрируется в set_webhook, Telegram возвращает его
+    заголовком в каждом POST - посторонние запросы отсекаются до разбора JSON.
+    """
+    webhook_url: str
+    webhook_secret: str
+    port: int
+    workers: int
+
+CFG = Config(
+    webhook_url=os.getenv("WEBHOOK_URL", "https://your-app.onrender.com/webhook"),
+    webhook_secret=os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32),
+    port=int(os.getenv("PORT", 8080)),
+    workers=int(os.getenv("WEB_WORKERS", "1")),
+)
+
+# Дедупликация апдейтов: Telegram повторяет POST, если не получил 200
+# за ~60 секунд, а долгий ответ LLM легко выходит за это окно - повтор
+# не должен второй раз запускать обработчики
+_SEEN_UPDATES_MAX = 10000
+
+try:
+    from cachetools import TTLCache
+    _seen_updates = TTLCache(maxsize=_SEEN_UPDATES_MAX, ttl=120)
+except ImportError:
+    # Фолбэк без cachetools: FIFO-вытеснение на OrderedDict, чтобы кэш
+    # не рос бесконечно в долгоживущем процессе
+    from collections import OrderedDict
+    _seen_updates = OrderedDict()
+
+def _remember_update(update_id):
+    """Отмечает update_id обработанным, не давая кэшу расти без предела"""
+    _seen_updates[update_id] = True
+    # TTLCache вытесняет сам; фолбэк-OrderedDict ограничиваем вручную
+    while len(_seen_updates) > _SEEN_UPDATES_MAX:
+        _seen_updates.popitem(last=False)
+
+# Тело и заголовки health-ответа готовим один раз: пробер Render бьет
+# в эндпоинт постоянно, кодировать строку на каждый запрос незачем
+_HEALTH_BODY = b"Bot is running!"
+_HEALTH_HEADERS = {"Content-Type": "text/plain; charset=utf-8"}
 
 async def health_check(request):
-    return web.Response(text="Bot is running!", status=200)
+    return web.Response(body=_HEALTH_BODY, status=200, headers=_HEALTH_HEADERS)
 
 async def webhook_handler(request):
     """Обработчик webhook для aiogram 3.x"""
+    # Сканеры и спуфленные POST не проходят дальше сравнения заголовка;
+    # compare_digest не дает подобрать секрет по времени ответа
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, CFG.webhook_secret):
+        return web.Response(status=401)
+
+    update_id = None
     try:
-        update_data = await request.json()
+        # Читаем сырые байты и разбираем сами: request.json() использует
+        # стандартный json и промежуточное декодирование в str
+        update_data = _json_loads(await request.read())
+
+        # Повторная доставка уже виденного update_id сразу получает 200
+        update_id = update_data.get("update_id")
+        if update_id is not None:
+            if update_id in _seen_updates:
+                return web.Response(status=200)
+            _remember_update(update_id)
+
         # Создаем объект Update из данных
         from aiogram.types import Update
         update = Update.model_validate(update_data)
@@ -29,49 +137,240 @@ async def webhook_handler(request):
         await dp.feed_update(update, bot)
         return web.Response(status=200)
     except Exception as e:
-        logger.error(f"Ошибка обработки webhook: {e}")
+        # Упавший апдейт убираем из кэша дедупликации: повтор от Telegram
+        # должен обработаться заново, а не проглотиться как дубликат
+        if update_id is not None:
+            _seen_updates.pop(update_id, None)
+        logger.error("Ошибка обработки webhook: %s", e)
         return web.Response(status=500)
 
-async def on_startup(app):
-    """Действия при запуске приложения"""
-    logger.info("🚀 Настройка webhook...")
-    try:
-        await bot.set_webhook(url=WEBHOOK_URL)
-        logger.info(f"✅ Webhook установлен: {WEBHOOK_URL}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка установки webhook: {e}")
+async def lifespan(app):
+    """Жизненный цикл приложения: настройка до yield, уборка после
 
-async def on_shutdown(app):
-    """Действия при остановке приложения"""
-    logger.info("🛑 Удаление webhook...")
+    Один cleanup_ctx-генератор вместо пары on_startup/on_shutdown -
+    aiohttp гарантирует, что уборка выполнится, если старт прошел.
+    """
+    # aiogram держит одну ClientSession на весь срок жизни бота - до ее
+    # ленивого создания (первый же вызов API ниже) подкручиваем коннектор:
+    # длинный keepalive и кэш DNS экономят TLS-хендшейки на исходящих вызовах
     try:
-        await bot.delete_webhook()
-        logger.info("✅ Webhook удален")
-    except Exception as e:
-        logger.error(f"❌ Ошибка удаления webhook: {e}")
-    
+        bot.session._connector_init.update(
+            limit=100,
+            limit_per_host=30,
+            keepalive_timeout=75,
+            ttl_dns_cache=300
+        )
+    except AttributeError:
+        logger.warning("⚠️ Не удалось настроить коннектор сессии aiogram")
+
+    # set_webhook вызывает только нулевой воркер: N одинаковых регистраций
+    # Telegram не нужны
+    is_primary_worker = os.getenv("WEBHOOK_WORKER_ID", "0") == "0"
+
+    async def _setup_webhook():
+        logger.info("🚀 Настройка webhook...")
+        try:
+            # drop_pending_updates: накопленный за рестарт бэклог не
+            # обрушивается на холодный процесс; allowed_updates сужает
+            # апдейты до типов с реальными обработчиками
+            await bot.set_webhook(
+                url=CFG.webhook_url,
+                secret_token=CFG.webhook_secret,
+                drop_pending_updates=True,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info("✅ Webhook установлен: %s", CFG.webhook_url)
+        except Exception as e:
+            logger.error("❌ Ошибка установки webhook: %s", e)
+
+    async def _warmup_dispatcher():
+        # Прогреваем pydantic-валидацию и цепочку фильтров синтетическим
+        # апдейтом до первого реального запроса: сообщение без текста
+        # проходит весь роутинг и завершается no-op в catch-all обработчике
+        try:
+            from aiogram.types import Update
+            warmup_update = Update.model_validate({
+                "update_id": 0,
+                "message": {
+                    "message_id": 0,
+                    "date": 0,
+                    "chat": {"id": 0, "type": "private"},
+                    "from": {"id": 0, "is_bot": False, "first_name": "warmup"},
+                },
+            })
+            await dp.feed_update(warmup_update, bot)
+            logger.info("🔥 Диспетчер прогрет")
+        except Exception as e:
+            logger.warning("⚠️ Прогрев диспетчера не удался: %s", e)
+
+    # Независимые шаги старта выполняются параллельно: прогрев не ждет
+    # round-trip'а set_webhook, health-чек Render проходит раньше.
+    # Энкодер токенов готовим в потоке - первый вызов может скачивать
+    # BPE-словарь и не должен блокировать event loop
+    async with asyncio.TaskGroup() as tg:
+        if is_primary_worker:
+            tg.create_task(_setup_webhook())
+        tg.create_task(_warmup_dispatcher())
+        tg.create_task(asyncio.to_thread(init_token_encoder))
+
+    yield
+
+    if is_primary_worker:
+        logger.info("🛑 Удаление webhook...")
+        try:
+            await bot.delete_webhook()
+            logger.info("✅ Webhook удален")
+        except Exception as e:
+            logger.error("❌ Ошибка удаления webhook: %s", e)
+
     # Закрываем сессии aiohttp
     logger.info("🛑 Закрытие сессий...")
     try:
+        await history_store.close()
+        await close_http_session()
         await bot.session.close()
         logger.info("✅ Сессии закрыты")
     except Exception as e:
-        logger.error(f"❌ Ошибка закрытия сессий: {e}")
+        logger.error("❌ Ошибка закрытия сессий: %s", e)
+
+def _install_uvloop():
+    """Ставит uvloop, если он доступен (вне Linux остаемся на asyncio)"""
+    # uvloop (libuv на C) заметно снижает накладные расходы event loop
+    # на каждый запрос
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("⚡ Используется uvloop")
+    except ImportError:
+        pass
+
+def _build_app() -> web.Application:
+    """Собирает aiohttp-приложение с маршрутами и событиями жизненного цикла"""
+    # Апдейты Telegram не превышают ~64 KiB: более крупные POST отклоняются
+    # парсером с 413 еще до выделения буфера под тело
+    app = web.Application(client_max_size=65536)
+
+    # Маршруты регистрируем пачкой, вебхук - первым: это горячий путь,
+    # health-эндпоинты для пробера идут следом
+    app.add_routes([
+        web.post(WEBHOOK_PATH, webhook_handler),
+        web.get("/", health_check),
+        web.get("/health", health_check),
+    ])
+
+    # Один генератор жизненного цикла вместо пары сигналов startup/shutdown
+    app.cleanup_ctx.append(lifespan)
+
+    return app
+
+async def _serve(port: int, reuse_port: bool = False):
+    """Запускает сервер через AppRunner/TCPSite с тюнингом слушающего сокета"""
+    # access_log=None: строка access-лога на каждый POST - чистые
+    # накладные расходы, весь трафик однотипный (вебхук + health-пробы)
+    runner = web.AppRunner(_build_app(), access_log=None)
+    await runner.setup()
+
+    # backlog=2048: очередь accept переживает всплески апдейтов без отказов
+    site = web.TCPSite(runner, "0.0.0.0", port, backlog=2048,
+                       reuse_address=True, reuse_port=reuse_port,
+                       shutdown_timeout=5.0)
+    await site.start()
+
+    # TCP_NODELAY убирает паузу Нейгла на маленьких JSON-ответах,
+    # SO_KEEPALIVE выметает мертвые соединения из FIN-WAIT
+    if site._server is not None:
+        for server_socket in site._server.sockets:
+            server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    logger.info("🌐 Сервер слушает порт %s", port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def _run_polling():
+    """Запускает long polling вместо вебхука (USE_WEBHOOK=0)
+
+    Для редких апдейтов одно keep-alive-соединение getUpdates дешевле,
+    чем TLS-обработка входящего POST на каждое сообщение.
+    """
+    try:
+        await asyncio.to_thread(init_token_encoder)
+        await bot.delete_webhook()
+        # allowed_updates по реально зарегистрированным обработчикам -
+        # Telegram не сериализует лишние типы апдейтов
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await history_store.close()
+        await close_http_session()
+
+def _run_worker(worker_id: int, port: int):
+    """Входная точка одного процесса-воркера"""
+    os.environ["WEBHOOK_WORKER_ID"] = str(worker_id)
+    _load_bot()
+    _install_uvloop()
+    # SO_REUSEPORT: все воркеры слушают один порт, ядро само балансирует
+    # входящие POST между процессами
+    asyncio.run(_serve(port, reuse_port=True))
+
+def _raise_fd_limit():
+    """Поднимает soft-лимит дескрипторов до жесткого потолка
+
+    Всплеск коротких TLS-соединений не должен упираться в дефолтные
+    1024 открытых файла; вне Unix модуля resource нет - молча пропускаем.
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            logger.info("📈 RLIMIT_NOFILE поднят: %s -> %s", soft, hard)
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning("⚠️ Не удалось поднять RLIMIT_NOFILE: %s", e)
 
 def main():
     logger.info("🚀 Запуск Telegram AI Bot (Webhook) - v2.0")
-    app = web.Application()
-    
-    # Добавляем обработчики
-    app.router.add_post(WEBHOOK_PATH, webhook_handler)
-    app.router.add_get("/", health_check)
-    
-    # Добавляем события запуска и остановки
-    app.on_startup.append(on_startup)
-    app.on_shutdown.append(on_shutdown)
-    
-    port = int(os.getenv("PORT", 8080))
-    web.run_app(app, port=port, host="0.0.0.0")
+
+    _raise_fd_limit()
+
+    # Дешевая проверка окружения до дорогого импорта бота: при
+    # неправильной конфигурации падаем сразу, не загружая aiogram
+    if not os.getenv("TELEGRAM_BOT_TOKEN") or not os.getenv("OPENROUTER_API_KEY"):
+        logger.error("❌ Не заданы TELEGRAM_BOT_TOKEN и/или OPENROUTER_API_KEY")
+        return
+
+    _load_bot()
+
+    # Переключатель на long polling для деплоев без публичного URL
+    if os.getenv("USE_WEBHOOK", "1") == "0":
+        logger.info("📡 USE_WEBHOOK=0 - запускаем long polling")
+        _install_uvloop()
+        asyncio.run(_run_polling())
+        return
+
+    port = CFG.port
+    workers = CFG.workers
+
+    if workers <= 1:
+        # Обычный однопроцессный запуск (SO_REUSEPORT не нужен и не везде есть)
+        _install_uvloop()
+        asyncio.run(_serve(port))
+        return
+
+    # Несколько процессов обходят GIL и занимают все ядра инстанса
+    import multiprocessing
+    processes = [
+        multiprocessing.Process(target=_run_worker, args=(worker_id, port))
+        for worker_id in range(1, workers)
+    ]
+    for process in processes:
+        process.start()
+
+    _run_worker(0, port)
+
+    for process in processes:
+        process.join()
 
 if __name__ == "__main__":
     main()